@@ -69,6 +69,9 @@ if sys.version_info >= (3, 0):
 # or the directory in the environment variable CBDATA, see findCbData()
 dataDir = None
 
+# the requests session used by downloadUrlLines(), see getHttpSession()
+httpSession = None
+
 # the default html dir, used if the --htmlDir option is set but empty
 # this variable is initialized below (no forward declaration in Python)
 # just before cbBuild_parseArgs
@@ -245,14 +248,47 @@ def downloadUrlBinary(remoteUrl):
         data = None
     return data
 
+def getHttpSession():
+    """ return a requests session that keeps connections to the same server open between
+    downloads. Returns None if the requests module is not installed. """
+    global httpSession
+    if httpSession is None:
+        try:
+            import requests, urllib3
+        except ImportError:
+            logging.debug("requests module not found, every download will use a new connection")
+            return None
+        httpSession = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8)
+        httpSession.mount("http://", adapter)
+        httpSession.mount("https://", adapter)
+        # like in downloadUrlBinary, do not check certificates
+        httpSession.verify = False
+        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    return httpSession
+
 def downloadUrlLines(url):
-    " open URL, slurp in all data and return a list of the text lines "
-    data = downloadUrlBinary(url)
+    " open URL and yield the text lines, uncompressed if the URL ends with .gz "
+    session = getHttpSession()
+    if session is None:
+        data = downloadUrlBinary(url)
+        if url.endswith(".gz"):
+            data = gzip.decompress(data)
+        for l in data.splitlines():
+            yield l.decode("latin1")
+        return
+
+    r = session.get(url, stream=True)
+    r.raise_for_status()
     if url.endswith(".gz"):
-        data = gzip.decompress(data)
-    lines = data.splitlines()
-    lines = [l.decode("latin1") for l in lines]
-    return lines
+        # servers may send "Content-Encoding: gzip" for .gz files. Do not let urllib3 decode that, the raw
+        # bytes are the .gz file and are gunzipped exactly once below
+        r.raw.decode_content = False
+        lines = gzip.GzipFile(fileobj=r.raw)
+    else:
+        lines = r.iter_lines(chunk_size=2**16)
+    for l in lines:
+        yield l.rstrip(b"\r\n").decode("latin1")
 
 def getDownloadsUrl():
     " return the big static file downloads URL on cells.ucsc.edu "
@@ -1202,8 +1238,16 @@ def moveOrGzip(inFname, outFname):
         renameFile(inFname, outFname)
 
 def runGzip(fname, finalFname=None):
-    " compress fname and move to finalFname when done, to make it atomic "
-    if which("gzip") is None:
+    """ compress fname and move to finalFname when done, to make it atomic.
+    Uses pigz on all cores if it is installed, otherwise gzip or Python's gzip module. """
+    gzipCmd = None
+    if which("pigz") is not None:
+        import multiprocessing
+        gzipCmd = "pigz -p %d" % multiprocessing.cpu_count()
+    elif which("gzip") is not None:
+        gzipCmd = "gzip"
+
+    if gzipCmd is None:
         logging.debug("gzip not found, falling back to Python's gzip")
         if finalFname is None:
             finalFname = fname+".gz"
@@ -1214,8 +1258,8 @@ def runGzip(fname, finalFname=None):
         ifh.close()
         ofh.close()
     else:
-        logging.debug("Compressing %s" % fname)
-        cmd = "gzip -f %s" % fname
+        logging.debug("Compressing %s with %s" % (fname, gzipCmd))
+        cmd = "%s -f %s" % (gzipCmd, fname)
         runCommand(cmd)
         gzipFname = fname+".gz"
 
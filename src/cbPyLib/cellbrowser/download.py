@@ -1,7 +1,7 @@
 # download data from single cell repos
 
-import logging, optparse, io, sys, os, shutil, operator
-from collections import defaultdict, OrderedDict, Counter
+import logging, optparse, io, sys, os, shutil, operator, csv, socket, queue, asyncio, ftplib
+from collections import OrderedDict, Counter
 
 from .cellbrowser import runGzip, openFile, errAbort, setDebug, moveOrGzip, makeDir, iterItems
 from .cellbrowser import mtxToTsvGz, writeCellbrowserConf, parseIntoColumns, readMatrixAnndata, splitOnce
@@ -9,6 +9,13 @@ from .cellbrowser import generateHtmls, writePyConf
 
 from os.path import join, basename, dirname, isfile, isdir, relpath, abspath, getsize, getmtime, expanduser
 
+# aioftp is not required, but it runs the parallel FTP downloads without threads, so use it if it's present
+aioftpLoaded = True
+try:
+    import aioftp
+except ImportError:
+    aioftpLoaded = False
+
 def cbGet_parseArgs(showHelp=False):
     " setup logging, parse command line arguments and options. -h shows auto-generated help page "
     parser = optparse.OptionParser("""usage: %prog [options] <repo> <accession> - import single cell data from repositories
@@ -28,6 +35,8 @@ def cbGet_parseArgs(showHelp=False):
         help="Input directory")
     parser.add_option("-o", "--outDir", dest="outDir", action="store",
         help="Output directory")
+    parser.add_option("-j", "--jobs", dest="jobs", action="store", type="int", default=4,
+        help="number of parallel FTP connections when downloading, default %default")
 
     (options, args) = parser.parse_args()
 
@@ -38,29 +47,128 @@ def cbGet_parseArgs(showHelp=False):
     setDebug(options.debug)
     return args, options
 
-def mirrorFtp(hostName, ftpDir, localDir):
-    " mirror an ftp directory to local disk "
-    makeDir(localDir)
-    from ftplib import FTP
-    logging.info("FTP: connecting to %s, dir %s" % (hostName, ftpDir))
-    ftp = FTP(hostName)
+def ftpConnect(hostName, ftpDir):
+    " open an anonymous ftp connection and change to ftpDir "
+    ftp = ftplib.FTP(hostName)
+    # the control connection sends many small commands, do not delay them
+    ftp.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
     ftp.login()
     ftp.cwd(ftpDir)
-
-    ls = ftp.nlst()
-    count = len(ls)
-    curr = 0
-    logging.info("Found {} files".format(count))
-    for fn in ls:
-        if fn=="complete":
-            continue
-        curr += 1
-        logging.info('Downloading file {} ... {} of {} ...'.format(fn, curr, count))
+    return ftp
+
+def getResumeOffset(outPath, remoteSize):
+    """ compare a local file with the size of the remote file. Return None if the local file is complete,
+    otherwise the number of bytes already downloaded (0 if there is no local file or it cannot be resumed) """
+    if remoteSize is None or not isfile(outPath):
+        return 0
+    localSize = getsize(outPath)
+    if localSize==remoteSize:
+        return None
+    if 0 < localSize < remoteSize:
+        return localSize
+    return 0
+
+def ftpDownloadFiles(hostName, ftpDir, localDir, todo, count):
+    """ keep one ftp connection open and download (fileIdx, fileName) from the queue todo until it is empty.
+    Skip or resume existing files. """
+    ftp = ftpConnect(hostName, ftpDir)
+    ftp.voidcmd("TYPE I") # some servers refuse SIZE in ASCII mode
+    while True:
+        try:
+            curr, fn = todo.get_nowait()
+        except queue.Empty:
+            break
         outPath = join(localDir, fn)
-        ftp.retrbinary('RETR ' + fn, open(outPath, 'wb').write)
+        try:
+            remoteSize = ftp.size(fn)
+        except ftplib.error_perm:
+            # SIZE is not implemented or fn is not a file: just download it
+            remoteSize = None
+        offset = getResumeOffset(outPath, remoteSize)
+        if offset is None:
+            logging.info('File {} ... {} of {} already downloaded'.format(fn, curr, count))
+            continue
+        if offset==0:
+            logging.info('Downloading file {} ... {} of {} ...'.format(fn, curr, count))
+            with open(outPath, 'wb', buffering=2**20) as ofh:
+                ftp.retrbinary('RETR ' + fn, ofh.write, blocksize=2**20)
+        else:
+            logging.info('Resuming file {} at byte {} ... {} of {} ...'.format(fn, offset, curr, count))
+            with open(outPath, 'ab', buffering=2**20) as ofh:
+                ftp.retrbinary('RETR ' + fn, ofh.write, blocksize=2**20, rest=offset)
+    ftp.quit()
 
+def mirrorFtpThreads(hostName, ftpDir, localDir, jobs):
+    " download all files in ftpDir with ftplib, using <jobs> parallel connections "
+    from concurrent.futures import ThreadPoolExecutor
+    ftp = ftpConnect(hostName, ftpDir)
+    ls = ftp.nlst()
     ftp.quit()
 
+    fnames = [fn for fn in ls if fn!="complete"]
+    count = len(fnames)
+    jobs = max(1, min(jobs, count))
+    logging.info("Found {} files, downloading with {} connections".format(count, jobs))
+
+    # one connection per worker, each takes the next file when it is done with the last one
+    todo = queue.Queue()
+    for numFname in enumerate(fnames, start=1):
+        todo.put(numFname)
+    executor = ThreadPoolExecutor(max_workers=jobs)
+    futures = [executor.submit(ftpDownloadFiles, hostName, ftpDir, localDir, todo, count) \
+            for i in range(jobs)]
+    executor.shutdown(wait=True)
+    for future in futures:
+        future.result() # re-raises any exception from the worker
+
+async def mirrorFtpAsync(hostName, ftpDir, localDir, jobs):
+    " download all files in ftpDir with aioftp, using <jobs> parallel connections "
+    async with aioftp.Client.context(hostName) as client:
+        ls = await client.list(ftpDir)
+
+    fileSizes = [(path.name, int(info["size"])) for path, info in ls \
+            if info["type"]=="file" and path.name!="complete"]
+    count = len(fileSizes)
+    jobs = max(1, min(jobs, count))
+    logging.info("Found {} files, downloading with {} connections".format(count, jobs))
+
+    todo = list(enumerate(fileSizes, start=1))
+
+    async def worker():
+        " keep one connection open and download files until none are left "
+        async with aioftp.Client.context(hostName) as client:
+            await client.change_directory(ftpDir)
+            while len(todo)!=0:
+                curr, (fn, remoteSize) = todo.pop(0)
+                outPath = join(localDir, fn)
+                offset = getResumeOffset(outPath, remoteSize)
+                if offset is None:
+                    logging.info('File {} ... {} of {} already downloaded'.format(fn, curr, count))
+                    continue
+                if offset==0:
+                    logging.info('Downloading file {} ... {} of {} ...'.format(fn, curr, count))
+                    mode = 'wb'
+                else:
+                    logging.info('Resuming file {} at byte {} ... {} of {} ...'.format(fn, offset, curr, count))
+                    mode = 'ab'
+                with open(outPath, mode, buffering=2**20) as ofh:
+                    async with client.download_stream(fn, offset=offset) as stream:
+                        async for block in stream.iter_by_block():
+                            ofh.write(block)
+
+    await asyncio.gather(*[worker() for i in range(jobs)])
+
+def mirrorFtp(hostName, ftpDir, localDir, jobs=4):
+    """ mirror an ftp directory to local disk, using <jobs> parallel connections.
+    Uses aioftp if it is installed, otherwise ftplib with one thread per connection. """
+    makeDir(localDir)
+    logging.info("FTP: connecting to %s, dir %s" % (hostName, ftpDir))
+    if aioftpLoaded:
+        asyncio.run(mirrorFtpAsync(hostName, ftpDir, localDir, jobs))
+    else:
+        logging.debug("aioftp not installed, falling back to ftplib")
+        mirrorFtpThreads(hostName, ftpDir, localDir, jobs)
+
     complFn = join(localDir, "complete")
     open(complFn, "w").close() # = create 0-size file
     logging.info("FTP download complete.")
@@ -98,17 +206,19 @@ def parseClusters(fname):
     return bestK, dict(zip(sampleNames, clusters))
 
 def parseCondSdrf(cellIds, fname):
-    """ parse the condensed sdrf into cellId -> dict of key-val """
-    cellIds = set(cellIds)
-    cellMeta = defaultdict(dict)
-    for line in open(fname):
-        #E-MTAB-7303             ERR2847884      characteristic  organism        Homo sapiens    http://purl.obolibrary.org/obo/NCBITaxon_9606
-        #E-MTAB-4850		SAMEA50486668	characteristic	age	42 year
-        row = line.rstrip("\n\r").split("\t")
-        dsId, _, cellId, _, fieldName, val = row[:6]
-        if cellId not in cellIds:
-            continue
-        cellMeta[cellId][fieldName] = val
+    """ parse the condensed sdrf into a pandas dataframe, one row per cellId, one column per field. Cells
+    without a value for a field get NaN. If a field appears twice for a cell, the last value wins. """
+    #E-MTAB-7303             ERR2847884      characteristic  organism        Homo sapiens    http://purl.obolibrary.org/obo/NCBITaxon_9606
+    #E-MTAB-4850		SAMEA50486668	characteristic	age	42 year
+    import pandas as pd
+    # only the rows with an ontology term have the 7th column. No usecols here: pandas refuses it if
+    # no row has seven fields
+    df = pd.read_csv(fname, sep="\t", header=None, names=list(range(7)), dtype=str, \
+            keep_default_na=False, quoting=csv.QUOTE_NONE, engine="c")[[2,4,5]]
+    df.columns = ["cellId", "fieldName", "val"]
+    df = df[df["cellId"].isin(set(cellIds))]
+    df = df.drop_duplicates(["cellId", "fieldName"], keep="last")
+    cellMeta = df.pivot(index="cellId", columns="fieldName", values="val")
     return cellMeta
 
 def parseSdrfFieldNames(sdrfFname):
@@ -157,7 +267,7 @@ def parseIdf(fname):
     " parse idf and return as dict key = value "
     logging.debug("Parsing %s" % fname)
     data = OrderedDict()
-    for line in open(fname, "Ut"):
+    for line in open(fname):
         if line.startswith("\n"):
             continue
         line = line.rstrip("\n")
@@ -169,74 +279,79 @@ def toStr(s):
     " prettify raw IDF tab-sep list to a normal string "
     return s.strip("\t").replace("\t", ", ")
 
+# desc.conf key -> IDF key, these are required in the IDF
+idfFields = [
+    ("title", "Investigation Title"),
+    ("abstract", "Experiment Description"),
+    ("design", "Experimental Design"),
+    ("expType", "Comment[EAExperimentType]"),
+    ("methods", "Protocol Description"),
+]
+
+# desc.conf key -> IDF key, these are only copied if present
+idfOptFields = [
+    ("pmid", "PubMed ID"),
+    ("doi", "Publication DOI"),
+    ("arrayexpress", "Comment[ArrayExpressAccession]"),
+    ("ena_project", "Comment [SecondaryAccession]"),
+]
+
 def translateIdf(idf):
     " convert dict read from IDF to a simple key-value format for the cell browser desc.conf "
     desc = OrderedDict()
-    desc["title"] = toStr(idf["Investigation Title"])
-    desc["abstract"] = toStr(idf["Experiment Description"])
-    desc["design"] = toStr(idf["Experimental Design"])
-    desc["expType"] = toStr(idf["Comment[EAExperimentType]"])
-    desc["methods"] = toStr(idf["Protocol Description"])
+    for descKey, idfKey in idfFields:
+        desc[descKey] = toStr(idf[idfKey])
     desc["curator"] = toStr(idf["Comment[EACurator]"])+", EBI Single Cell Expression Atlas"
     desc["submitter"] = toStr(idf["Person First Name"])+" "+toStr(idf["Person Last Name"])+" <"+toStr(idf["Person Email"])+">"
     desc["submission_date"] = toStr(idf["Public Release Date"])
-    if "PubMed ID" in idf:
-        desc["pmid"] = toStr(idf["PubMed ID"])
-    if "Publication DOI" in idf:
-        desc["doi"] = toStr(idf["Publication DOI"])
-
-    if "Comment[ArrayExpressAccession]" in idf:
-        desc["arrayexpress"] = toStr(idf["Comment[ArrayExpressAccession]"])
 
-    if "Comment [SecondaryAccession]" in idf:
-        desc["ena_project"] = toStr(idf["Comment [SecondaryAccession]"])
+    for descKey, idfKey in idfOptFields:
+        if idfKey in idf:
+            desc[descKey] = toStr(idf[idfKey])
 
     return desc
 
 def convertCoords(coordFname, newCoordFname):
     " simply reorder columns"
-    ofh = open(newCoordFname, "w")
-    for line in open(coordFname):
-        row = line.rstrip("\n\r").split("\t")
-        newRow = (row[2], row[0], row[1])
-        ofh.write("\t".join(newRow))
-        ofh.write("\n")
-    ofh.close()
+    import pandas as pd
+    if not isfile(coordFname):
+        errAbort("Coordinate file %s does not exist" % coordFname)
+    # keep everything as strings and do not touch quotes, so the values are copied over unchanged
+    try:
+        df = pd.read_csv(coordFname, sep="\t", header=None, dtype=str, engine="c", keep_default_na=False, \
+                quoting=csv.QUOTE_NONE)
+    except pd.errors.EmptyDataError:
+        logging.warning("Coordinate file %s is empty" % coordFname)
+        open(newCoordFname, "w").close()
+        return
+    df[[2, 0, 1]].to_csv(newCoordFname, sep="\t", header=False, index=False, quoting=csv.QUOTE_NONE)
     logging.info("Wrote %s" % newCoordFname)
 
 def convertMarkers(inFname, outFname):
     " reorder columns and reheader and return list of one top marker per cluster "
     #names	groups	scores	logfc	pvals	pvals_adj
     #ENSG00000112096	0	9.120421	1.4149776	3.5174541399729827e-15	5.52275474517158e-11
-    ofh = open(outFname, "w")
-    clusterToMarkers = defaultdict(list)
-    for line in open(inFname):
-        row = line.rstrip("\n\r").split("\t")
-        #cluster, pval, auroc, gene = row
-        geneId, cluster, score, logfc, pval, pvalAdj = row
-        if row[0]=="names":
-            newRow = ["Cluster", "Gene", "p-Value Adj.", "p-Value", "logFC", "score"]
-        else:
-            newRow = (row[1], row[0], row[5], row[4], row[3], row[2])
-            clusterToMarkers[cluster].append( (float(pvalAdj), geneId) )
+    import pandas as pd
+    df = pd.read_csv(inFname, sep="\t", dtype=str, engine="c", keep_default_na=False, quoting=csv.QUOTE_NONE)
 
-        ofh.write("\t".join(newRow))
-        ofh.write("\n")
-
-    ofh.close()
+    newNames = {"groups":"Cluster", "names":"Gene", "pvals_adj":"p-Value Adj.", "pvals":"p-Value", \
+            "logfc":"logFC", "scores":"score"}
+    newDf = df[list(newNames)].rename(columns=newNames)
+    newDf.to_csv(outFname, sep="\t", index=False, quoting=csv.QUOTE_NONE)
     logging.info("Wrote %s" % outFname)
 
-    topMarkers = {}
-    for cluster, pValGenes in iterItems(clusterToMarkers):
-        pValGenes.sort()
-        topGene = pValGenes[0][1]
-        topMarkers[cluster] = topGene
+    # lowest adj. p-value per cluster, ties are broken by gene ID. Keep the clusters in the order of the
+    # marker file, writeQuickGenes writes them in this order
+    clusterOrder = df["groups"].unique()
+    df["pvalAdjNum"] = df["pvals_adj"].astype(float)
+    df = df.sort_values(["pvalAdjNum", "names"])
+    topMarkers = df.groupby("groups")["names"].first().reindex(clusterOrder).to_dict()
 
     return topMarkers
 
 def writeQuickGenes(topGenes, outFname):
     " given cluster -> gene, create a quickGenes file "
-    ofh = open(outFname, "w")
+    ofh = open(outFname, "w", buffering=2**20)
     for cluster, gene in iterItems(topGenes):
         ofh.write("%s\tCluster %s\n"% (gene, cluster))
     ofh.close()
@@ -319,10 +434,7 @@ def writeMeta(clusters, cellIds, sdrfFields, boringFields, cellMeta, metaFname):
     logging.debug("Fields in the SDRF: %s" % sdrfFields)
     logging.debug("Boring fields: %s" % boringFields.keys())
 
-    allFields = set()
-    for cellId in cellIds:
-        meta = cellMeta[cellId]
-        allFields.update(meta.keys())
+    allFields = set(cellMeta.columns)
     logging.debug("All fields from the condensed: %s" % allFields)
 
     fieldOrder = []
@@ -335,52 +447,42 @@ def writeMeta(clusters, cellIds, sdrfFields, boringFields, cellMeta, metaFname):
     logging.debug("final field order: %s" % fieldOrder)
     assert(len(set(fieldOrder))==len(fieldOrder)) # fields must not appear twice
 
-    ofh = open(metaFname, "w")
-    ofh.write("cell ID\tcluster\t")
-    ofh.write("\t".join(fieldOrder))
-    ofh.write("\n")
-
-    for cellId, meta in iterItems(cellMeta):
-        row = [cellId]
-        clustId = clusters.get(cellId, "Unknown")
-        row.append(clustId)
-        for fieldName in fieldOrder:
-            val = meta.get(fieldName, "")
-            row.append(val)
-        ofh.write("\t".join(row))
-        ofh.write("\n")
-    ofh.close()
-    logging.info("Wrote %s" % ofh.name)
+    import pandas as pd
+    # same cell order as in the matrix
+    meta = cellMeta.reindex(index=cellIds, columns=fieldOrder)
+    # the SDRF can have its own "cluster" field, keep both columns, like the old text output did
+    meta.insert(0, "cluster", pd.Series(clusters).reindex(cellIds).fillna("Unknown"), allow_duplicates=True)
+    meta.to_csv(metaFname, sep="\t", index_label="cell ID", na_rep="", quoting=csv.QUOTE_NONE)
+    logging.info("Wrote %s" % metaFname)
 
-def findBoringFields(cellMetaDict):
+def findBoringFields(cellMeta):
     """ return a dict of all fieldNames that have only a single value. The keys of this dict are the field names, 
     the values of this dict are the single values."""
-    fieldValues = defaultdict(set)
-    for cellId, cellMeta in iterItems(cellMetaDict):
-        for fieldName, val in iterItems(cellMeta):
-            fieldValues[fieldName].add(val)
-
     boringFields = {}
-    for fieldName, vals in iterItems(fieldValues):
+    for fieldName in cellMeta.columns:
         if fieldName.endswith("_FILE_NAME") or fieldName.endswith("_URI") or fieldName=="single cell identifier":
             logging.debug("Skipping field %s" % fieldName)
             boringFields[fieldName] = None
             continue
+        vals = cellMeta[fieldName].dropna().unique()
         if len(vals)==1:
-            boringFields[fieldName] = list(vals)[0]
+            boringFields[fieldName] = vals[0]
     return boringFields
 
 def writeAcronyms(cellMeta, acroFname):
     " extract acronyms from inferred cell name field "
     ofh = open(acroFname, "w")
-    for cellId, metaDict in iterItems(cellMeta):
-        cellName = metaDict.get("inferred cell type")
-        if cellName and "(" in cellName:
-            longName, shortName = cellName.split("(")
-            longName = longName.strip()
-            shortName = shortName.strip(")")
-            metaDict["inferred cell type"] = shortName
-            ofh.write(shortName+"\t"+longName+"\n")
+    fieldName = "inferred cell type"
+    if fieldName in cellMeta.columns:
+        cellNames = cellMeta[fieldName]
+        hasAcro = cellNames.str.contains("(", regex=False).fillna(False).astype(bool)
+        if hasAcro.any():
+            parts = cellNames[hasAcro].str.split("(", n=1, expand=True)
+            longNames = parts[0].str.strip()
+            shortNames = parts[1].str.strip(")")
+            cellMeta.loc[hasAcro, fieldName] = shortNames
+            for shortName, longName in sorted(set(zip(shortNames, longNames))):
+                ofh.write(shortName+"\t"+longName+"\n")
     ofh.close()
     logging.info("Wrote %s" % ofh.name)
     return cellMeta
@@ -474,7 +576,7 @@ def cbGetCli():
             if not isfile(flagFname):
                 hostName = "ftp.ebi.ac.uk"
                 ftpDir = "/pub/databases/microarray/data/atlas/sc_experiments/%s" % acc
-                mirrorFtp(hostName, ftpDir, origDir)
+                mirrorFtp(hostName, ftpDir, origDir, options.jobs)
         convertFromEbi(origDir, acc, outDir)
     else:
         errAbort("Repository %s is not valid. Valid repos are: %s" % (cmd, ", ".join(cmds)))
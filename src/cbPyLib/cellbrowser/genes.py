@@ -1,15 +1,34 @@
 # functions to guess the gene model release given a list of gene IDs
 # tested on python3 and python2
-import logging, sys, optparse, string, glob, gzip, json
+import logging, sys, optparse, string, glob, gzip, json, io, csv, itertools, functools
+from sys import intern
 from io import StringIO
 #from urllib.request import urlopen
 from urllib.request import Request, urlopen
-from collections import defaultdict
+from collections import defaultdict, Counter
 from os.path import join, basename, dirname, isfile
 
-from .cellbrowser import sepForFile, getStaticFile, openFile, splitOnce, setDebug, getStaticPath
+from .cellbrowser import sepForFile, getStaticFile, openFile, setDebug, getStaticPath
 from .cellbrowser import getGeneSymPath, downloadUrlLines, getSymToGene, getGeneBedPath, errAbort, iterItems
 from .cellbrowser import findCbData, readGeneSymbols, getGeneJsonPath, getDownloadsUrl
+from .cellbrowser import downloadUrlBinary, makeDir, renameFile
+
+# rapidgzip is not required, but it decompresses gzip files on all cores, so use it if it's present
+rapidgzipLoaded = True
+try:
+    import rapidgzip
+except ImportError:
+    rapidgzipLoaded = False
+
+# orjson is not required either, but it is a lot faster than the json module
+orjsonLoaded = True
+try:
+    import orjson
+except ImportError:
+    orjsonLoaded = False
+
+# str.translate table that removes everything but the digits from a gene ID
+nonDigitsTable = str.maketrans("", "", "".join([chr(i) for i in range(256) if chr(i) not in string.digits]))
 
 # ==== functions =====
 def cbGenes_parseArgs():
@@ -49,6 +68,18 @@ def cbGenes_parseArgs():
     return args, options
 
 # ----------- main --------------
+def openBufferedFile(fname, bufSize=2**18):
+    """ open a text file for reading. gzip files are decompressed in parallel with rapidgzip, if
+    installed, otherwise they get a 256k read buffer, which is a lot faster than the default when
+    iterating over lines """
+    if not fname.endswith(".gz"):
+        return openFile(fname)
+    if rapidgzipLoaded:
+        return io.TextIOWrapper(rapidgzip.open(fname, parallelization=0), encoding="latin1")
+    raw = gzip.open(fname, "rb")
+    buf = io.BufferedReader(raw, buffer_size=bufSize)
+    return io.TextIOWrapper(buf, encoding="latin1")
+
 def parseSignatures(org, geneIdType):
     " return dict with gene release -> list of unique signature genes "
     ret = {}
@@ -57,7 +88,7 @@ def parseSignatures(org, geneIdType):
     logging.info("Parsing %s" % fname)
     genes = set()
     verToGenes = {}
-    for line in openFile(fname):
+    for line in openBufferedFile(fname):
         if line.startswith("#"):
             continue
         version, geneIds = line.rstrip("\n").split('\t')
@@ -79,18 +110,15 @@ def guessGeneIdType(genes):
 
 def parseGenes(fname):
     " return gene IDs in column 1 of file "
-    fileGenes = set()
-    headDone = False
+    import pandas as pd
     logging.info("Parsing first column from %s" % fname)
     sep = sepForFile(fname)
-    for line in openFile(fname):
-        if not headDone:
-            headDone = True
-            continue
-        geneId = splitOnce(line[:50], sep)[0]
-        geneId = geneId.strip("\n").strip("\r").strip()
-        #fileGenes.add(geneId.split('.')[0].split("|")[0])
-        fileGenes.add(geneId.split("|")[0])
+    # index_col=False: R's write.table leaves out the row name column in the header
+    col = pd.read_csv(fname, sep=sep, usecols=[0], dtype=str, header=0, engine="c", keep_default_na=False, \
+            index_col=False).iloc[:,0]
+    #col = col.str.split(".", n=1).str[0]
+    col = col.str.split("|", n=1).str[0].str.strip()
+    fileGenes = set(col.dropna())
     logging.info("Read %d genes" % len(fileGenes))
     return fileGenes
 
@@ -98,16 +126,16 @@ def guessGencodeVersion(fileGenes, signGenes):
     logging.info("Number of genes that are only in a gene model release:")
     diffs = []
     for version, uniqGenes in signGenes.items():
-        intersection = list(fileGenes.intersection(uniqGenes))
+        # set.intersection() only loops over uniqGenes, no need to copy the result into a list
+        intersection = fileGenes.intersection(uniqGenes)
         infoStr = "release "+version+": %d out of %d" % (len(intersection), len(uniqGenes))
         if len(intersection)!=0:
-            expStr = ", ".join(intersection[:5])
+            expStr = ", ".join(itertools.islice(intersection, 5))
             infoStr += (" e.g. "+ expStr)
         logging.info(infoStr)
         diffs.append((len(intersection), version))
 
-    diffs.sort(reverse=True)
-    bestVersion = diffs[0][1]
+    bestVersion = max(diffs)[1]
 
     return bestVersion
 
@@ -136,8 +164,10 @@ def buildSymbolTable(geneType):
     outFname = getStaticPath(getGeneSymPath(geneType))
     writeRows(rows, outFname)
 
-def iterGencodePairs(release, doTransGene=False):
-    " generator, yields geneId,symbol or transId,geneId pairs for a given gencode release"
+@functools.lru_cache(maxsize=None)
+def downloadGencodeAttrs(release):
+    """ download the UCSC gencode attributes table for a release to the local data directory, unless it's
+    already there, and return its path. 'build' needs this file for both the symbol table and the BED file """
     # e.g. trackName = "wgEncodeGencodeBasicV34"
     #attrFname = trackName.replace("Basic", "Attrs").replace("Comp", "Attrs")
     #assert(release[1:].isdigit())
@@ -146,17 +176,36 @@ def iterGencodePairs(release, doTransGene=False):
         db = "mm10"
     if release in ["7", "14", "17", "19"] or "lift" in release:
         db = "hg19"
-    url = "https://hgdownload.cse.ucsc.edu/goldenPath/%s/database/wgEncodeGencodeAttrsV%s.txt.gz" %  (db, release)
-    logging.info("Downloading %s" % url)
+    fname = "wgEncodeGencodeAttrsV%s.txt.gz" % release
+    localPath = getStaticPath(join("genes", "ucsc", db, fname))
+    if isfile(localPath):
+        logging.info("Using %s" % localPath)
+        return localPath
+
+    url = "https://hgdownload.cse.ucsc.edu/goldenPath/%s/database/%s" %  (db, fname)
+    logging.info("Downloading %s to %s" % (url, localPath))
+    data = downloadUrlBinary(url)
+    if data is None:
+        errAbort("Could not download %s" % url)
+
+    makeDir(dirname(localPath))
+    localTmp = localPath+".download"
+    with open(localTmp, "wb") as ofh:
+        ofh.write(data)
+    renameFile(localTmp, localPath)
+    return localPath
+
+def iterGencodePairs(release, doTransGene=False):
+    " generator, yields geneId,symbol or transId,geneId pairs for a given gencode release"
+    fname = downloadGencodeAttrs(release)
     doneIds = set()
-    for line in downloadUrlLines(url):
+    for line in openBufferedFile(fname):
         row = line.rstrip("\n").split("\t")
 
         if doTransGene:
-            # key = transcript ID, val is geneId
+            # key = transcript ID, val is geneId. Many transcripts share a gene, so store each geneId only once
             key = row[4]
-            val = row[0]
-            val = val
+            val = intern(row[0])
         else:
             # key = geneId, val is symbol
             key = row[0]
@@ -173,18 +222,18 @@ def iterGencodeBed(db, release):
 
     url = "http://hgdownload.cse.ucsc.edu/goldenPath/%s/database/wgEncodeGencodeCompV%s.txt.gz" % (db, release)
     logging.info("Downloading %s" % url)
-    geneToTransList = defaultdict(list)
+    # pick one transcript per gene while reading, prefer older transcripts
+    geneToTrans = {}
     for line in downloadUrlLines(url):
         row = tuple(line.split('\t'))
         transId = row[1]
         geneId = transToGene[transId]
-        score = int(''.join(c for c in geneId if c.isdigit())) # extract only the xxx part of the ENSGxxx ID
-        geneToTransList[geneId].append( (score, row) )
+        score = int(geneId.translate(nonDigitsTable)) # extract only the xxx part of the ENSGxxx ID
+        trans = (score, row)
+        if geneId not in geneToTrans or trans < geneToTrans[geneId]:
+            geneToTrans[geneId] = trans
 
-    logging.info("Picking one transcript per gene")
-    for geneId, transList in iterItems(geneToTransList):
-        transList.sort() # prefer older transcripts
-        canonTransRow = transList[0][1]
+    for geneId, (_, canonTransRow) in iterItems(geneToTrans):
         binIdx, name, chrom, strand, txStart, txEnd, cdsStart, cdsEnd, exonCount, exonStarts, exonEnds, score, name2, cdsStartStat, cdsEndStat, exonFrames = canonTransRow
         blockStarts = []
         blockLens = []
@@ -197,11 +246,16 @@ def iterGencodeBed(db, release):
         newRow = [chrom, txStart, txEnd, geneId, score, strand, cdsStart, cdsEnd, exonCount, ",".join(blockLens), ",".join(blockStarts), name2]
         yield newRow
 
-def writeRows(rows, outFname):
+def writeRows(rows, outFname, chunkSize=1000):
+    " write rows to a tab-sep file, in chunks of chunkSize lines "
     with openFile(outFname, "wt") as ofh:
+        chunk = []
         for row in rows:
-            ofh.write("\t".join(row))
-            ofh.write("\n")
+            chunk.append("\t".join(row)+"\n")
+            if len(chunk)==chunkSize:
+                ofh.writelines(chunk)
+                chunk = []
+        ofh.writelines(chunk)
     logging.info("Wrote %s" % outFname)
 
 def buildLocusBed(db, geneType):
@@ -238,8 +292,8 @@ def iterBedRows(db, geneIdType):
     " yield BED rows of gene models of given type "
     fname = getStaticPath(getGeneBedPath(db, geneIdType))
     logging.info("Reading BED file %s" % fname)
-    with openFile(fname) as ofh:
-        for line in ofh:
+    with openBufferedFile(fname) as ifh:
+        for line in ifh:
             row = line.rstrip("\n\r").split("\t")
             yield row
 
@@ -282,12 +336,15 @@ def listModelRemoteBuild():
             ("hg19", "https://hgdownload.cse.ucsc.edu/goldenPath/hg19/database/")
             ]
 
+    # download the three directory listings at the same time
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=len(urls)) as ex:
+        dirFnames = list(ex.map(lambda dbUrl: parseApacheDir(downloadUrlLines(dbUrl[1])), urls))
+
     allNames = defaultdict(list)
-    for db, url in urls:
+    for (db, url), fnames in zip(urls, dirFnames):
         print()
         print("Files available for 'build' for assembly %s (%s)" % (db, url))
-        lines = downloadUrlLines(url)
-        fnames = parseApacheDir(lines)
         geneFnames = [x for x in fnames if x.startswith("wgEncodeGencodeAttrs") and x.endswith(".txt.gz")]
         relNames = [x.replace("wgEncodeGencodeAttrsV", "gencode-").replace(".txt.gz", "") for x in geneFnames]
         allNames[db].extend(relNames)
@@ -300,21 +357,20 @@ def listModelRemoteBuild():
 
 def keepOnlyUnique(dictSet):
     """ give a dict with key -> set, return a dict with key -> set, but only with elements in the set that
-    that don't appear in any other set
+    that don't appear in any other set. Also returns the number of elements that are in all sets.
     """
-    uniqVals = {}
-    for key1, origVals in dictSet.items():
-        vals = set(list(origVals))
+    # count in how many sets every value appears
+    valCounts = Counter()
+    for vals in dictSet.values():
+        valCounts.update(vals)
 
-        for key2 in dictSet.keys():
-            if key1==key2:
-                continue
-            vals = vals - dictSet[key2]
-        uniqVals[key1] = vals
+    uniqVals = {}
+    for key, vals in dictSet.items():
+        uniqVals[key] = {v for v in vals if valCounts[v]==1}
 
-    setList = list(dictSet.values())
-    allCommon = set.intersection(*setList)
-    return uniqVals, len(allCommon)
+    setCount = len(dictSet)
+    commonCount = sum(1 for count in valCounts.values() if count==setCount)
+    return uniqVals, commonCount
 
 def writeUniqs(dictSet, outFname):
     " wrote to output file in format <key>tab<comma-sep-list of vals> "
@@ -323,6 +379,13 @@ def writeUniqs(dictSet, outFname):
         for key, vals in dictSet.items():
             ofh.write("%s\t%s\n" % (key, "|".join(vals)))
 
+def readIdSymSets(fname):
+    " read the first two columns of a geneId/symbol file and return them as two sets "
+    import pandas as pd
+    df = pd.read_csv(fname, sep="\t", header=None, usecols=[0,1], names=["id", "sym"], dtype=str, \
+            keep_default_na=False, quoting=csv.QUOTE_NONE, engine="c")
+    return set(df["id"].values), set(df["sym"].values)
+
 def uniqueIds(org):
     """ find unique identifiers in all symbols and geneIds of infileMask and write to
     outBase.{syms,ids}.unique.syms.tsv.gz
@@ -344,13 +407,7 @@ def uniqueIds(org):
         geneType = basename(fname).split(".")[0]
         logging.info("Reading %s" % fname)
 
-        syms = set()
-        ids = set()
-        for line in openFile(fname):
-            row = line.rstrip("\n").split("\t")
-            geneId, sym = row[:2]
-            syms.add(sym)
-            ids.add(geneId)
+        ids, syms = readIdSymSets(fname)
         allSyms[geneType] = syms
         allIds[geneType] = ids
 
@@ -366,33 +423,34 @@ def bedToJson(db, geneIdType, jsonFname):
     " convert BED file to more compact json file: chrom -> list of (start, end, strand, gene) "
     geneToSym = readGeneSymbols(geneIdType)
 
-    # index transcripts by gene
-    bySym = defaultdict(dict)
+    # keep only the longest transcript per symbol and chrom
+    bestTrans = {}
     for row in iterBedRows(db, geneIdType):
         chrom, start, end, geneId, score, strand = row[:6]
         sym = geneToSym[geneId]
         start = int(start)
         end = int(end)
         transLen = end-start
-        bySym[sym].setdefault(chrom, []).append( (transLen, start, end, strand, geneId) )
+        trans = (transLen, start, end, strand, geneId)
+        key = (sym, chrom)
+        if key not in bestTrans or trans > bestTrans[key]:
+            bestTrans[key] = trans
 
     symLocs = defaultdict(list)
-    for sym, chromDict in bySym.items():
-        for chrom, transList in chromDict.items():
-            transList.sort(reverse=True) # take longest transcript per chrom
-            _, start, end, strand, transId = transList[0]
-            symLocs[chrom].append( (start, end, strand, sym) )
+    for (sym, chrom), (_, start, end, strand, transId) in bestTrans.items():
+        symLocs[chrom].append( (start, end, strand, sym) )
 
     sortedLocs = {}
     for chrom, geneList in symLocs.items():
         geneList.sort()
         sortedLocs[chrom] = geneList
 
-    ofh = open(jsonFname, "wt")
-    outs = json.dumps(sortedLocs)
-    #md5 = hashlib.md5(outs.encode("utf8")).hexdigest()[:10]
-    ofh.write(outs)
-    ofh.close()
+    if orjsonLoaded:
+        with open(jsonFname, "wb") as ofh:
+            ofh.write(orjson.dumps(sortedLocs))
+    else:
+        with open(jsonFname, "wt", buffering=2**20) as ofh:
+            json.dump(sortedLocs, ofh, separators=(',',':'))
     logging.info("Wrote %s" % jsonFname)
 
     #fileInfo[code] = {"label":label, "file" : jsonFname, "md5" :md5}